@@ -692,6 +692,12 @@ class MockVocabulary(object):
 
 
 def sentencepiece_vocab(extra_ids=0):
+  return _sentencepiece_vocab(extra_ids)
+
+
+# Takes `extra_ids` positionally so every call style shares one cache entry.
+@functools.lru_cache(maxsize=None)
+def _sentencepiece_vocab(extra_ids):
   return vocabularies.SentencePieceVocabulary(
       os.path.join(TEST_DATA_DIR, "sentencepiece", "sentencepiece.model"),
       extra_ids=extra_ids)
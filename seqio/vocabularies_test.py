@@ -14,70 +14,161 @@
 
 """Tests for seqio.vocabularies."""
 
+import functools
+
 from absl.testing import absltest
+from absl.testing import parameterized
 import numpy as np
 from seqio import test_utils
 from seqio import vocabularies
 import tensorflow.compat.v2 as tf
 
-tf.compat.v1.enable_eager_execution()
-
 mock = absltest.mock
 
 
-def _decode_tf(vocab, tokens):
-  return vocab.decode_tf(tf.constant(tokens, tf.int32)).numpy().decode("UTF-8")
-
-
-class VocabularyTest(absltest.TestCase):
-
-  TEST_STR = "Testing."
-  TEST_IDS = [84, 101, 115, 116, 105, 110, 103, 46]
-
-  class AsciiVocab(vocabularies.Vocabulary):
+def _t(ids):
+  return tf.convert_to_tensor(np.asarray(ids, np.int32))
 
-    def __init__(self, extra_ids=0, use_eos=True, use_unk=True):
-      super().__init__(extra_ids=extra_ids)
-      self._extra_ids = extra_ids
-      self._use_eos = use_eos
-      self._use_unk = use_unk
 
-    @property
-    def eos_id(self):
-      return 1 if self._use_eos else None
+def _concat_ids(*ids):
+  return np.concatenate([np.asarray(i, np.int32) for i in ids])
 
-    @property
-    def unk_id(self):
-      return 2 if self._use_unk else None
 
-    @property
-    def _base_vocab_size(self):
-      return 128
+def _zeros_pad(ids, n):
+  return _concat_ids(ids, np.zeros(n, np.int32))
 
-    def _encode(self, s):
-      return [ord(c) for c in s]
 
-    def _decode(self, ids):
-      return "".join("<eos>" if id == 1 else chr(id) for id in ids if id > 0)
-
-    def _encode_tf(self, s):
-      return tf.strings.unicode_decode(s, "UTF-8")
+def _decode_tf(vocab, tokens):
+  return vocab.decode_tf(_t(tokens)).numpy()
+
+
+@functools.lru_cache(maxsize=None)
+def _byte_decode_table():
+  # Decoded string for each byte-sized id; PAD decodes to nothing. Built on
+  # first trace rather than at import, under init_scope so it stays eager.
+  with tf.init_scope():
+    return tf.constant(["", "<eos>"] + [chr(i) for i in range(2, 256)])
+
+
+class AsciiVocab(vocabularies.Vocabulary):
+
+  def __init__(self, extra_ids=0, use_eos=True, use_unk=True):
+    super().__init__(extra_ids=extra_ids)
+    self._extra_ids = extra_ids
+    self._use_eos = use_eos
+    self._use_unk = use_unk
+    # Not jit compiled: XLA has no kernels for tf.string outputs.
+    self._decode_tf_fn = tf.function(
+        self._decode_tf_impl,
+        input_signature=[tf.TensorSpec([None, None], tf.int32)])
+
+  @property
+  def eos_id(self):
+    return 1 if self._use_eos else None
+
+  @property
+  def unk_id(self):
+    return 2 if self._use_unk else None
+
+  @property
+  def _base_vocab_size(self):
+    return 128
+
+  def _encode(self, s):
+    # UTF-32 code units are codepoints, matching ord() for any character.
+    return np.frombuffer(
+        s.encode("utf-32-le", "surrogatepass"), "<u4").tolist()
+
+  def _decode(self, ids):
+    ids = np.asarray(ids, np.int32)
+    if ids.size and (ids.min() < 0 or ids.max() > 255):
+      # Ids outside a byte decode as their codepoint, like chr(id).
+      text = ids[ids > 0].astype("<u4").tobytes().decode(
+          "utf-32-le", "surrogatepass")
+    else:
+      # Delete padding and expand EOS in two C-level passes over the bytes.
+      text = ids.astype(np.uint8).tobytes().translate(None, b"\x00")
+      text = text.decode("latin-1")
+    return text.replace("\x01", "<eos>")
+
+  def _encode_tf(self, s):
+    return tf.strings.unicode_decode(s, "UTF-8")
+
+  def _decode_tf(self, ids):
+    if ids.shape.rank == 1:
+      return tf.squeeze(self._decode_tf_fn(tf.expand_dims(ids, 0)), 0)
+    return self._decode_tf_fn(ids)
+
+  def _decode_tf_impl(self, ids):
+    chars = tf.gather(_byte_decode_table(), tf.clip_by_value(ids, 0, 255))
+    beyond_table = tf.greater(ids, 255)
+    # Ids past the table decode as their codepoint, like chr(id). UTF-8 can't
+    # hold surrogates (0xD800-0xDFFF), so those become U+FFFD instead.
+    chars = tf.cond(
+        tf.reduce_any(beyond_table),
+        lambda: tf.where(  # pylint:disable=g-long-lambda
+            beyond_table,
+            tf.strings.unicode_encode(tf.expand_dims(ids, -1), "UTF-8"),
+            chars),
+        lambda: chars)
+    return tf.strings.reduce_join(chars, axis=-1)
+
+
+# AsciiVocab is stateless, so tests share one instance per
+# (use_eos, use_unk, extra_ids) config.
+@functools.lru_cache(maxsize=None)
+def _shared_ascii_vocab(use_eos, use_unk, extra_ids):
+  return AsciiVocab(use_eos=use_eos, use_unk=use_unk, extra_ids=extra_ids)
+
+
+class VocabularyTest(parameterized.TestCase):
 
-    def _decode_tf(self, ids):
-      s = tf.strings.unicode_encode(ids, "UTF-8")
-      s = tf.strings.regex_replace(s, chr(0), "")
-      s = tf.strings.regex_replace(s, chr(1), "<eos>")
-      return s
+  TEST_STR = "Testing."
+  TEST_IDS = [84, 101, 115, 116, 105, 110, 103, 46]
+  TEST_IDS_ARR = np.array(TEST_IDS, np.int32)
+
+  _EXPECTED_UNK_EOS = "\x02" + TEST_STR + "\x7f\x02<eos>"
+  _EXPECTED_UNK_EARLY_EOS = "\x02" + TEST_STR + "<eos>"
+  _EXPECTED_UNK_ONLY = "\x02" + TEST_STR + "\x7f\x02<eos>!<eos>"
+  _EXPECTED_EOS_ONLY = "¡" + TEST_STR + "\x7f¿<eos>"
+  _EXPECTED_EOS_ONLY_NO_EOS = "¡" + TEST_STR + "\x7f¿"
+  _EXPECTED_NO_UNK_OR_EOS = "¡" + TEST_STR + "\x7f¿<eos>!<eos>"
+  _EXPECTED_NO_UNK_BEYOND_BYTE = TEST_STR + "\u012c<eos>"
+
+  # (name, use_eos, use_unk, extra_ids, ids, expected string) per decode case.
+  _DECODE_CASES = (
+      ("unk_and_eos", True, True, 0,
+       _concat_ids([161], TEST_IDS_ARR, [127, 191, 1, 0, 10]),
+       _EXPECTED_UNK_EOS),
+      ("unk_only", False, True, 35,
+       _concat_ids([161], TEST_IDS_ARR, [127, 191, 1, 33, 1]),
+       _EXPECTED_UNK_ONLY),
+      ("eos_only", True, False, 0,
+       _concat_ids([161], TEST_IDS_ARR, [127, 191, 1, 33, 1]),
+       _EXPECTED_EOS_ONLY),
+      ("eos_only_no_eos", True, False, 0,
+       _concat_ids([161], TEST_IDS_ARR, [127, 191]),
+       _EXPECTED_EOS_ONLY_NO_EOS),
+      ("eos_only_leading_eos", True, False, 0,
+       _concat_ids([1], TEST_IDS_ARR),
+       "<eos>"),
+      ("no_unk_or_eos", False, False, 0,
+       _concat_ids([161], TEST_IDS_ARR, [127, 191, 1, 33, 1]),
+       _EXPECTED_NO_UNK_OR_EOS),
+      ("no_unk_beyond_byte", True, False, 300,
+       _concat_ids(TEST_IDS_ARR, [300, 1, 33]),
+       _EXPECTED_NO_UNK_BEYOND_BYTE),
+  )
 
   def test_properties(self):
-    test_vocab = self.AsciiVocab(use_eos=False, use_unk=True, extra_ids=10)
+    test_vocab = _shared_ascii_vocab(False, True, 10)
     self.assertEqual(test_vocab.extra_ids, 10)
     self.assertEqual(test_vocab.pad_id, 0)
     self.assertIsNone(test_vocab.eos_id)
     self.assertEqual(test_vocab.unk_id, 2)
     self.assertEqual(test_vocab.vocab_size, 128 + 10)
 
-    test_vocab = self.AsciiVocab(use_eos=True, use_unk=False)
+    test_vocab = _shared_ascii_vocab(True, False, 0)
     self.assertEqual(test_vocab.extra_ids, 0)
     self.assertEqual(test_vocab.pad_id, 0)
     self.assertEqual(test_vocab.eos_id, 1)
@@ -85,65 +176,49 @@ class VocabularyTest(absltest.TestCase):
     self.assertEqual(test_vocab.vocab_size, 128)
 
   def test_encode(self):
-    test_vocab = self.AsciiVocab()
+    test_vocab = _shared_ascii_vocab(True, True, 0)
     self.assertSequenceEqual(test_vocab.encode(self.TEST_STR), self.TEST_IDS)
-    self.assertSequenceEqual(
-        tuple(test_vocab.encode_tf(self.TEST_STR).numpy()),
-        self.TEST_IDS)
-
-  def test_decode_unk_and_eos(self):
-    test_vocab = self.AsciiVocab(use_eos=True, use_unk=True)
-    test_ids = [161] + self.TEST_IDS + [127, 191, 1, 0, 10]
-    test_str = "\x02" + self.TEST_STR + "\x7f\x02<eos>"
-    self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
-
-  def test_decode_unk_only(self):
-    test_vocab = self.AsciiVocab(use_eos=False, use_unk=True, extra_ids=35)
-    test_ids = [161] + self.TEST_IDS + [127, 191, 1, 33, 1]
-    test_str = "\x02" + self.TEST_STR + "\x7f\x02<eos>!<eos>"
-    self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
-
-  def test_decode_eos_only(self):
-    test_vocab = self.AsciiVocab(use_eos=True, use_unk=False)
-    test_ids = [161] + self.TEST_IDS + [127, 191, 1, 33, 1]
-    test_str = "¡" + self.TEST_STR + "\x7f¿<eos>"
-    self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
-
-    test_ids = [161] + self.TEST_IDS + [127, 191]
-    test_str = "¡" + self.TEST_STR + "\x7f¿"
-    self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
+    np.testing.assert_array_equal(
+        test_vocab.encode_tf(self.TEST_STR), self.TEST_IDS_ARR)
 
-    test_ids = [1] + self.TEST_IDS
-    test_str = "<eos>"
+  @parameterized.named_parameters(*_DECODE_CASES)
+  def test_decode(self, use_eos, use_unk, extra_ids, test_ids, test_str):
+    test_vocab = _shared_ascii_vocab(use_eos, use_unk, extra_ids)
     self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
+    self.assertEqual(
+        _decode_tf(test_vocab, test_ids), test_str.encode("UTF-8"))
 
-  def test_decode_no_unk_or_eos(self):
-    test_vocab = self.AsciiVocab(use_eos=False, use_unk=False)
-    test_ids = [161] + self.TEST_IDS +  [127, 191, 1, 33, 1]
-    test_str = "¡" + self.TEST_STR + "\x7f¿<eos>!<eos>"
-    self.assertEqual(test_vocab.decode(test_ids), test_str)
-    self.assertEqual(_decode_tf(test_vocab, test_ids), test_str)
+  def test_decode_surrogate(self):
+    test_vocab = _shared_ascii_vocab(True, False, 0)
+    test_ids = _concat_ids(self.TEST_IDS_ARR, [0xD800])
+    self.assertEqual(test_vocab.decode(test_ids), self.TEST_STR + "\ud800")
+    self.assertEqual(
+        _decode_tf(test_vocab, test_ids),
+        (self.TEST_STR + "\ufffd").encode("UTF-8"))
 
   def test_decode_tf_batch(self):
-    test_vocab = self.AsciiVocab(use_eos=True, use_unk=True)
-    test_ids = (
-        [161] + self.TEST_IDS +  [127, 191, 1, 33, 1],
-        [161] + self.TEST_IDS +  [1, 191, 1, 33, 1],
-    )
+    test_vocab = _shared_ascii_vocab(True, True, 0)
+    test_ids = np.stack([
+        _concat_ids([161], self.TEST_IDS_ARR, [127, 191, 1, 33, 1]),
+        _concat_ids([161], self.TEST_IDS_ARR, [1, 191, 1, 33, 1]),
+    ])
+    test_str = (self._EXPECTED_UNK_EOS, self._EXPECTED_UNK_EARLY_EOS)
+    self.assertSequenceEqual(
+        list(test_vocab.decode_tf(_t(test_ids)).numpy()),
+        [s.encode("UTF-8") for s in test_str])
+
+  def test_decode_tf_padded_batch(self):
+    test_vocab = _shared_ascii_vocab(True, False, 0)
+    test_ids = np.stack([
+        _concat_ids([161], self.TEST_IDS_ARR, [127, 191, 1, 33, 1]),
+        _zeros_pad(_concat_ids([161], self.TEST_IDS_ARR, [127, 191]), 3),
+        _zeros_pad(_concat_ids([1], self.TEST_IDS_ARR), 5),
+    ])
     test_str = (
-        "\x02" + self.TEST_STR + "\x7f\x02<eos>",
-        "\x02" + self.TEST_STR + "<eos>",
-    )
-    decoded = [
-        dec.decode("UTF-8") for dec in
-        test_vocab.decode_tf(tf.constant(test_ids, tf.int32)).numpy()
-    ]
-    self.assertSequenceEqual(decoded, test_str)
+        self._EXPECTED_EOS_ONLY, self._EXPECTED_EOS_ONLY_NO_EOS, "<eos>")
+    self.assertSequenceEqual(
+        list(test_vocab.decode_tf(_t(test_ids)).numpy()),
+        [s.encode("UTF-8") for s in test_str])
 
 
 class PassThroughVocabularyTest(absltest.TestCase):
@@ -156,7 +231,7 @@ class PassThroughVocabularyTest(absltest.TestCase):
     self.assertEqual(128, vocab.vocab_size)
     self.assertSequenceEqual(ids, vocab.encode(ids))
     self.assertSequenceEqual(ids, vocab.decode(ids))
-    ids_t = tf.constant([ids], tf.int32)
+    ids_t = _t([ids])
     np.testing.assert_equal(ids_t, vocab.encode_tf(ids_t).numpy())
     np.testing.assert_equal(ids_t, vocab.decode_tf(ids_t).numpy())
 
@@ -168,10 +243,10 @@ class PassThroughVocabularyTest(absltest.TestCase):
     self.assertEqual(1, vocab.eos_id)
     self.assertSequenceEqual(ids, vocab.encode(ids))
     self.assertSequenceEqual(ids[0:4], vocab.decode(ids))
-    ids_t = tf.constant([ids], tf.int32)
+    ids_t = _t([ids])
     np.testing.assert_equal(ids_t, vocab.encode_tf(ids_t).numpy())
     np.testing.assert_equal(
-        [ids[0:4] + [0]*5], vocab.decode_tf(ids_t).numpy())
+        _zeros_pad(ids[0:4], 5)[np.newaxis], vocab.decode_tf(ids_t).numpy())
 
 
 class SentencepieceVocabularyTest(absltest.TestCase):
@@ -185,10 +260,11 @@ class SentencepieceVocabularyTest(absltest.TestCase):
     self.assertEqual(26, vocab.vocab_size)
     self.assertSequenceEqual(self.TEST_TOKENS, vocab.encode(self.TEST_STRING))
     self.assertEqual(self.TEST_STRING, vocab.decode(self.TEST_TOKENS))
-    self.assertSequenceEqual(
-        self.TEST_TOKENS,
-        tuple(vocab.encode_tf(self.TEST_STRING).numpy()))
-    self.assertEqual(self.TEST_STRING, _decode_tf(vocab, self.TEST_TOKENS))
+    np.testing.assert_array_equal(
+        vocab.encode_tf(self.TEST_STRING),
+        np.asarray(self.TEST_TOKENS, np.int32))
+    self.assertEqual(
+        self.TEST_STRING.encode("UTF-8"), _decode_tf(vocab, self.TEST_TOKENS))
 
   def test_extra_ids(self):
     vocab = test_utils.sentencepiece_vocab(extra_ids=10)
@@ -197,15 +273,17 @@ class SentencepieceVocabularyTest(absltest.TestCase):
     test_string = "<extra_id_0> <extra_id_1> v <extra_id_9>"
     test_tokens = (35, 34, 3, 25, 26)
     self.assertEqual(test_string, vocab.decode(test_tokens))
-    self.assertEqual(test_string, _decode_tf(vocab, test_tokens))
+    self.assertEqual(
+        test_string.encode("UTF-8"), _decode_tf(vocab, test_tokens))
     self.assertSequenceEqual(test_tokens, vocab.encode(test_string))
-    self.assertSequenceEqual(
-        test_tokens,
-        tuple(vocab.encode_tf(test_string).numpy()))
+    np.testing.assert_array_equal(
+        vocab.encode_tf(test_string), np.asarray(test_tokens, np.int32))
 
   def test_equal(self):
     vocab1 = test_utils.sentencepiece_vocab()
-    vocab2 = test_utils.sentencepiece_vocab()
+    # Load the model again so equality isn't just identity.
+    vocab2 = vocabularies.SentencePieceVocabulary(
+        vocab1.sentencepiece_model_file)
     self.assertEqual(vocab1, vocab2)
 
   def test_not_equal(self):
@@ -220,36 +298,41 @@ class ByteVocabularyTest(absltest.TestCase):
   TEST_BYTE_IDS = (
       119, 107, 108, 118, 35, 108, 118, 35, 100, 35, 119, 104, 118, 119)
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls._byte_vocab = vocabularies.ByteVocabulary()
+    cls._byte_vocab_x10 = vocabularies.ByteVocabulary(extra_ids=10)
+
   def test_vocab(self):
-    vocab = vocabularies.ByteVocabulary()
+    vocab = self._byte_vocab
     self.assertEqual(259, vocab.vocab_size)
     self.assertSequenceEqual(self.TEST_BYTE_IDS, vocab.encode(self.TEST_STRING))
     self.assertEqual(self.TEST_STRING, vocab.decode(self.TEST_BYTE_IDS))
+    np.testing.assert_array_equal(
+        vocab.encode_tf(self.TEST_STRING),
+        np.asarray(self.TEST_BYTE_IDS, np.int32))
     self.assertEqual(
-        self.TEST_BYTE_IDS,
-        tuple(vocab.encode_tf(self.TEST_STRING).numpy()))
-    self.assertEqual(self.TEST_STRING, _decode_tf(vocab, self.TEST_BYTE_IDS))
+        self.TEST_STRING.encode("UTF-8"),
+        _decode_tf(vocab, self.TEST_BYTE_IDS))
 
   def test_extra_ids(self):
-    vocab = vocabularies.ByteVocabulary(extra_ids=10)
+    vocab = self._byte_vocab_x10
     self.assertEqual(269, vocab.vocab_size)
     self.assertEqual("a", vocab.decode([100]))
     self.assertEqual("", vocab.decode([268]))
 
   def test_out_of_vocab(self):
-    vocab = vocabularies.ByteVocabulary()
+    vocab = self._byte_vocab
     self.assertEqual(259, vocab.vocab_size)
     self.assertEqual("", vocab.decode([260]))
 
   def test_equal(self):
-    vocab1 = vocabularies.ByteVocabulary()
-    vocab2 = vocabularies.ByteVocabulary()
-    self.assertEqual(vocab1, vocab2)
+    # Compare against a fresh instance so equality isn't just identity.
+    self.assertEqual(self._byte_vocab, vocabularies.ByteVocabulary())
 
   def test_not_equal(self):
-    vocab1 = vocabularies.ByteVocabulary()
-    vocab2 = vocabularies.ByteVocabulary(10)
-    self.assertNotEqual(vocab1, vocab2)
+    self.assertNotEqual(self._byte_vocab, self._byte_vocab_x10)
 
 if __name__ == "__main__":
   absltest.main()